@@ -1,3 +1,4 @@
+import json
 import sys
 import requests
 import pandas as pd
@@ -49,7 +50,8 @@ class VINDecoder(QWidget):
         # Update the file label and load the file into a Pandas DataFrame
         if file_name:
             self.file_label.setText(file_name)
-            self.df = pd.read_excel(file_name) if file_name.endswith('.xlsx') else pd.read_csv(file_name)
+            # Read every column as str: skips dtype inference and keeps VINs and codes from being mangled into numbers
+            self.df = pd.read_excel(file_name, dtype=str) if file_name.endswith('.xlsx') else pd.read_csv(file_name, dtype=str)
             self.input_text.setPlainText(str(self.df.head()))
             self.vin_column.addItems(self.df.columns)
             self.decode_button.setEnabled(True)
@@ -67,11 +69,12 @@ class VINDecoder(QWidget):
                 data={'format': 'json', 'data': vin_string}
             )
             if response.status_code == 200:
-                data = response.json()['Results']
+                # Parse the raw bytes; json.loads detects the UTF encoding itself, so requests never decodes the body
+                data = json.loads(response.content)['Results']
                 for d in data:
                     decoded_data.append(d)
             else:
-                print('Error:', response.status_code, response.text)
+                print('Error:', response.status_code, response.content.decode('ascii', 'replace'))
                 break
             # Update the progress bar
             self.progress_bar.setValue((i + 1) * 100 // len(batches))
@@ -1,12 +1,58 @@
-import pandas as pd
-import requests
+import csv
+import io
+import logging
 import os
+import queue
+import re
+import sqlite3
+import threading
+import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+API_URL = 'https://vpic.nhtsa.dot.gov/api/vehicles/DecodeVINValuesBatch/'
+BATCH_SIZE = 50  # NHTSA's per-call limit for DecodeVINValuesBatch
+MAX_CONCURRENT_BATCHES = 16
+MAX_IN_FLIGHT_BATCHES = 32
+WRITE_QUEUE_SIZE = 16
+BYTES_PER_MB = 1024 * 1024
+WRITE_BUFFER_SIZE = 1 << 20
+RESPONSE_CHUNK_SIZE = 1 << 16
+ZSTD_LEVEL = 3
+CACHE_PATH = 'vin_cache.db'
+CACHE_INSERT_BATCH_SIZE = 1000
+CACHE_QUERY_CHUNK_SIZE = 900  # Stays under sqlite's default limit of 999 bound parameters
+
+# 17 characters from the VIN alphabet (ISO 3779), which excludes I, O and Q
+VIN_PATTERN = re.compile(r'[A-HJ-NPR-Z0-9]{17}', re.IGNORECASE)
+# ISO 3779 check digit: transliterated character values and per-position weights
+VIN_CHAR_VALUES = {**{str(digit): digit for digit in range(10)},
+                   'A': 1, 'B': 2, 'C': 3, 'D': 4, 'E': 5, 'F': 6, 'G': 7, 'H': 8,
+                   'J': 1, 'K': 2, 'L': 3, 'M': 4, 'N': 5, 'P': 7, 'R': 9,
+                   'S': 2, 'T': 3, 'U': 4, 'V': 5, 'W': 6, 'X': 7, 'Y': 8, 'Z': 9}
+VIN_POSITION_WEIGHTS = (8, 7, 6, 5, 4, 3, 2, 10, 0, 9, 8, 7, 6, 5, 4, 3, 2)
+
+logger = logging.getLogger(__name__)
+
+# Shared keep-alive session so every batch reuses pooled TLS connections instead of
+# paying a fresh handshake per request.
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32,
+                                      max_retries=Retry(total=5, backoff_factor=0.5,
+                                                        status_forcelist=[429, 500, 502, 503, 504],
+                                                        allowed_methods=None)))
 
 
 def read_vins_from_csv(file_path="to_be_decoded.csv", vin_column_name="VIN"):
     """
     Reads VINs from a specified CSV file.
 
+    The file is streamed row by row with the csv module, so only the VIN column is kept in memory.
+    Files ending in .parquet are read with pyarrow instead, loading only the VIN column.
+
     Args:
         file_path (str): The path to the CSV file.
         vin_column_name (str): The name of the column containing VINs.
@@ -14,276 +60,653 @@ def read_vins_from_csv(file_path="to_be_decoded.csv", vin_column_name="VIN"):
     Returns:
         list: A list of VINs, or an empty list if an error occurs.
     """
+    if file_path.endswith(".parquet"):
+        return read_vins_from_parquet(file_path, vin_column_name)
+
     try:
-        df = pd.read_csv(file_path)
-        if vin_column_name in df.columns:
-            vins = df[vin_column_name].dropna().astype(str).tolist()
-            if not vins:
-                print(f"Error: No VINs found in column '{vin_column_name}' in {file_path}.")
+        with open(file_path, newline='', encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            if not header:
+                logger.error("VIN column '%s' not found and the CSV is empty or has no columns.", vin_column_name)
                 return []
-            return vins
-        else:
-            # Try using the first column if the specified column name is not found
-            if not df.empty and len(df.columns) > 0:
-                print(
-                    f"Warning: VIN column '{vin_column_name}' not found. Using the first column '{df.columns[0]}' as VIN source.")
-                vins = df.iloc[:, 0].dropna().astype(str).tolist()
-                if not vins:
-                    print(f"Error: No VINs found in the first column '{df.columns[0]}' in {file_path}.")
-                    return []
-                return vins
+
+            if vin_column_name in header:
+                col_idx = header.index(vin_column_name)
             else:
-                print(f"Error: VIN column '{vin_column_name}' not found and the CSV is empty or has no columns.")
+                # Try using the first column if the specified column name is not found
+                col_idx = 0
+                logger.warning("VIN column '%s' not found. Using the first column '%s' as VIN source.",
+                               vin_column_name, header[0])
+
+            vins = [row[col_idx].strip() for row in reader if len(row) > col_idx and row[col_idx].strip()]
+            if not vins:
+                logger.error("No VINs found in column '%s' in %s.", header[col_idx], file_path)
                 return []
+            return vins
     except FileNotFoundError:
-        print(f"Error: File not found at {file_path}")
+        logger.error("File not found at %s", file_path)
         return []
-    except pd.errors.EmptyDataError:
-        print(f"Error: The file {file_path} is empty.")
+    except StopIteration:
+        logger.error("The file %s is empty.", file_path)
         return []
     except Exception as e:
-        print(f"An unexpected error occurred while reading {file_path}: {e}")
+        logger.error("An unexpected error occurred while reading %s: %s", file_path, e)
         return []
 
 
-def append_results_to_csv_with_rollover(raw_csv_batch_data, base_filename, current_file_idx, max_size_mb=500,
-                                        existing_headers_string=None):
+def read_vins_from_parquet(file_path, vin_column_name="VIN"):
     """
-    Appends a batch of raw CSV data to a CSV file, handling file rollover and headers.
+    Reads VINs from a specified Parquet file, loading only the VIN column. Requires pyarrow.
 
     Args:
-        raw_csv_batch_data (str): The raw CSV string data from an API batch.
-        base_filename (str): The base name for output files (e.g., "decoded_vins_output").
-        current_file_idx (int): The current index for the output file (0 for base, 1 for base1.csv, etc.).
-        max_size_mb (int): The maximum file size in megabytes before rollover.
-        existing_headers_string (str, optional): The header string of the current active file (stripped of newlines). Defaults to None.
+        file_path (str): The path to the Parquet file.
+        vin_column_name (str): The name of the column containing VINs.
 
     Returns:
-        tuple: (updated_current_file_idx, updated_existing_headers_string, output_filename)
+        list: A list of VINs, or an empty list if an error occurs.
     """
-    max_size_bytes = max_size_mb * 1024 * 1024
+    try:
+        import pyarrow.parquet as pq
 
-    # Determine current output filename
-    if current_file_idx == 0:
-        output_filename = f"{base_filename}.csv"
-    else:
-        output_filename = f"{base_filename}{current_file_idx}.csv"
-
-    # Initial rollover check: if current file already exists and is too large
-    if os.path.exists(output_filename) and os.path.getsize(output_filename) > max_size_bytes:
-        print(
-            f"File {output_filename} (size {os.path.getsize(output_filename) / (1024 * 1024):.2f}MB) already exceeds {max_size_mb}MB. Rolling over before write.")
-        current_file_idx += 1
-        existing_headers_string = None  # New file will need new headers
-        # Update output_filename for the new current_file_idx
-        if current_file_idx == 0:
-            output_filename = f"{base_filename}.csv"
+        column_names = pq.read_schema(file_path).names
+        if not column_names:
+            logger.error("VIN column '%s' not found and the file has no columns.", vin_column_name)
+            return []
+        if vin_column_name not in column_names:
+            # Try using the first column if the specified column name is not found
+            logger.warning("VIN column '%s' not found. Using the first column '%s' as VIN source.",
+                           vin_column_name, column_names[0])
+            vin_column_name = column_names[0]
+
+        column = pq.read_table(file_path, columns=[vin_column_name]).column(0)
+        vins = [str(vin).strip() for vin in column.to_pylist() if vin is not None and str(vin).strip()]
+        if not vins:
+            logger.error("No VINs found in column '%s' in %s.", vin_column_name, file_path)
+            return []
+        return vins
+    except FileNotFoundError:
+        logger.error("File not found at %s", file_path)
+        return []
+    except Exception as e:
+        logger.error("An unexpected error occurred while reading %s: %s", file_path, e)
+        return []
+
+
+class RolloverCsvWriter:
+    """
+    Appends batches of raw CSV data to a series of CSV files, handling file rollover and headers.
+
+    The active output file is opened on its first write and kept open across batches. Writes go
+    through a large userspace buffer, so consecutive batches are coalesced into a single write
+    syscall. The file is only flushed, fsync'ed and closed when it rolls over or when the writer
+    itself is closed.
+
+    With compress=True, files are written as zstd streams (base.csv.zst, base1.csv.zst, etc.) and
+    the rollover threshold applies to the compressed size. This requires the zstandard package.
+
+    Args:
+        base_filename (str): The base name for output files (e.g., "decoded_vins_output").
+        max_size_mb (int): The maximum file size in megabytes before rollover.
+        buffer_size (int): Size in bytes of the write buffer for the active output file.
+        compress (bool): Whether to zstd-compress the output files.
+    """
+
+    _extension = ".csv"
+
+    def __init__(self, base_filename, max_size_mb=500, buffer_size=WRITE_BUFFER_SIZE, compress=False):
+        self.base_filename = base_filename
+        self.max_size_mb = max_size_mb
+        self.buffer_size = buffer_size
+        self.max_size_bytes = max_size_mb * BYTES_PER_MB
+        self.current_file_idx = 0  # 0 for base, 1 for base1.csv, etc.
+        self.current_headers = None  # Header line of the current active file (bytes, stripped of newlines)
+        self.current_file_size = None  # Tracked in memory once the active file has been stat'ed
+        self._compressor = None
+        if compress:
+            import zstandard
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            self._extension = ".csv.zst"
+        self.output_filename = self._filename_for(self.current_file_idx)
+        self._raw_fh = None  # The underlying file
+        self._out_fh = None  # What batches are written to: the file itself, or a zstd stream wrapping it
+        self._size_at_open = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _filename_for(self, file_idx):
+        return f"{self.base_filename}{file_idx or ''}{self._extension}"
+
+    def _stat_size(self):
+        try:
+            return os.stat(self.output_filename).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _open_file(self, header):
+        self._size_at_open = self.current_file_size
+        self._raw_fh = self._out_fh = open(self.output_filename, 'ab', buffering=self.buffer_size)
+        if self._compressor is not None:
+            # zstd frames can be concatenated, so appending a new frame to an existing file is valid
+            self._out_fh = self._compressor.stream_writer(self._raw_fh, closefd=False)
+
+    def _close_file(self):
+        if self._out_fh is not None:
+            if self._out_fh is not self._raw_fh:
+                self._out_fh.close()  # Ends the zstd frame
+            self._raw_fh.flush()
+            os.fsync(self._raw_fh.fileno())
+            self._raw_fh.close()
+            self._raw_fh = self._out_fh = None
+
+    def _write(self, header, body, write_header):
+        if write_header:
+            buffer = header + b"\n" + body + b"\n" if body else header + b"\n"
         else:
-            output_filename = f"{base_filename}{current_file_idx}.csv"
-        print(f"New output file will be {output_filename}")
-
-    # Normalize raw_csv_batch_data and split into lines
-    clean_raw_csv_batch_data = str(raw_csv_batch_data).strip()
-    if not clean_raw_csv_batch_data:
-        return current_file_idx, existing_headers_string, output_filename  # Return current output_filename even if nothing is written
-
-    # Refined Line Preparation:
-    temp_lines = clean_raw_csv_batch_data.splitlines()
-    current_batch_lines_list = []
-    for l in temp_lines:
-        stripped_l = l.strip()
-        if stripped_l:  # Only add non-empty lines
-            current_batch_lines_list.append(stripped_l)
-
-    if not current_batch_lines_list:
-        return current_file_idx, existing_headers_string, output_filename
-
-    header_line_of_this_batch = current_batch_lines_list[0]
-
-    lines_to_actually_write = []
-    final_headers_for_this_file = existing_headers_string
-    file_exists_before_write = os.path.exists(output_filename)
-
-    if not file_exists_before_write or not existing_headers_string:
-        lines_to_actually_write = current_batch_lines_list
-        final_headers_for_this_file = header_line_of_this_batch
-    else:
-        if header_line_of_this_batch == existing_headers_string:
-            if len(current_batch_lines_list) > 1:
-                lines_to_actually_write = current_batch_lines_list[1:]
+            buffer = body + b"\n"
+
+        self._out_fh.write(buffer)
+        if self._compressor is not None:
+            self.current_file_size = self._size_at_open + self._out_fh.tell()
+        else:
+            self.current_file_size += len(buffer)
+
+    def _roll_over(self):
+        self._close_file()
+        self.current_file_idx += 1
+        self.current_headers = None  # New file will need new headers
+        self.output_filename = self._filename_for(self.current_file_idx)
+        self.current_file_size = None
+
+    def append(self, header, body):
+        """
+        Appends one parsed batch to the active output file.
+
+        Args:
+            header (bytes): The header line of the batch (stripped of newlines).
+            body (bytes): The batch's data lines joined by newlines, as returned by parse_batch. May be empty.
+
+        Returns:
+            str or None: The output filename the batch was written to (or would have been, if there was
+                nothing to write), or None if writing it failed.
+        """
+        # A batch with different headers starts a new file rather than being mixed into this one
+        if self.current_headers and header != self.current_headers:
+            logger.info("Batch headers for %s do not match existing file headers. Rolling over to a new file.\n"
+                        "File headers: '%s'\nBatch headers: '%s'", self.output_filename,
+                        self.current_headers.decode(errors='replace'), header.decode(errors='replace'))
+            self._roll_over()
+
+        # Only stat the file the first time it is seen; after that its size is tracked in memory
+        if self.current_file_size is None:
+            self.current_file_size = self._stat_size()
+
+        # Initial rollover check: if current file already exists and is too large
+        if self.current_file_size > self.max_size_bytes:
+            logger.info("File %s (size %.2fMB) already exceeds %sMB. Rolling over before write.",
+                        self.output_filename, self.current_file_size / BYTES_PER_MB, self.max_size_mb)
+            self._roll_over()
+            self.current_file_size = self._stat_size()
+            logger.info("New output file will be %s", self.output_filename)
+
+        output_filename = self.output_filename
+
+        # An open handle means this writer already wrote to the file; the compressed size can still read 0 then
+        file_has_content_before_write = self.current_file_size > 0 or self._out_fh is not None
+
+        if not file_has_content_before_write or not self.current_headers:
+            write_batch = write_header = True
+            self.current_headers = header
         else:
-            print(
-                f"Warning: Batch headers for {output_filename} do not match existing file headers. Skipping this batch.")
-            print(f"File headers: '{existing_headers_string}'")
-            print(f"Batch headers: '{header_line_of_this_batch}'")
+            write_batch = bool(body)
+            write_header = False
 
-    if lines_to_actually_write:
-        try:
-            with open(output_filename, 'a') as f:
-                for line in lines_to_actually_write:  # these lines are already stripped and non-empty
-                    f.write(line + os.linesep)
+        if write_batch:
+            try:
+                if self._out_fh is None:
+                    self._open_file(header)
+
+                self._write(header, body, write_header)
+
+                if self.current_file_size > self.max_size_bytes:
+                    logger.info("File %s (size %.2fMB) now exceeds %sMB after writing. Next batch will use a new file index.",
+                                output_filename, self.current_file_size / BYTES_PER_MB, self.max_size_mb)
+                    self._roll_over()
+            except IOError as e:
+                logger.error("IOError saving results to %s: %s", output_filename, e)
+                return None
+            except Exception as e:
+                logger.error("An unexpected error occurred while saving results to %s: %s", output_filename, e)
+                return None
 
-            new_file_size = os.path.getsize(output_filename)
-            if new_file_size > max_size_bytes:
-                print(
-                    f"File {output_filename} (size {new_file_size / (1024 * 1024):.2f}MB) now exceeds {max_size_mb}MB after writing. Next batch will use a new file index.")
-                current_file_idx += 1
-                final_headers_for_this_file = None
-        except IOError as e:
-            print(f"IOError saving results to {output_filename}: {e}")
-        except Exception as e:
-            print(f"An unexpected error occurred while saving results to {output_filename}: {e}")
+        return output_filename
 
-    return current_file_idx, final_headers_for_this_file, output_filename
+    def close(self):
+        """
+        Flushes, fsyncs and closes the active output file, if one is open.
+        """
+        self._close_file()
 
 
-def remove_blank_rows_from_file(file_path):
+class RolloverParquetWriter(RolloverCsvWriter):
     """
-    Reads a file, removes lines that are empty or contain only whitespace,
-    and overwrites the file with the cleaned content.
+    Appends batches of raw CSV data to a series of zstd-compressed Parquet files, handling file rollover.
+
+    Each batch becomes one row group, with every column stored as a string. Parquet files cannot be
+    appended to, so files left by a previous run are skipped rather than reused. Requires pyarrow.
 
     Args:
-        file_path (str): The path to the file to clean.
+        base_filename (str): The base name for output files (e.g., "decoded_vins_output").
+        max_size_mb (int): The maximum file size in megabytes before rollover.
     """
-    if not os.path.exists(file_path):
-        print(f"Post-processing: File {file_path} not found. Skipping.")
-        return
 
-    try:
-        with open(file_path, 'r') as f:
-            lines = f.readlines()
+    _extension = ".parquet"
+
+    def __init__(self, base_filename, max_size_mb=500):
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+        self._pa = pyarrow
+        super().__init__(base_filename, max_size_mb)
+        self._schema = None
+        self._skip_existing_files()
+
+    def _skip_existing_files(self):
+        while os.path.exists(self.output_filename):
+            self.current_file_idx += 1
+            self.output_filename = self._filename_for(self.current_file_idx)
+        self.current_file_size = 0
+
+    def _open_file(self, header):
+        pa = self._pa
+        self._schema = pa.schema([(name, pa.string()) for name in next(csv.reader([header.decode()]))])
+        self._raw_fh = pa.OSFile(self.output_filename, 'wb')
+        self._out_fh = pa.parquet.ParquetWriter(self._raw_fh, self._schema, compression='zstd')
+
+    def _close_file(self):
+        if self._out_fh is not None:
+            self._out_fh.close()  # Writes the Parquet footer; the sink stays open
+            os.fsync(self._raw_fh.fileno())
+            self._raw_fh.close()
+            self._raw_fh = self._out_fh = None
+
+    def _write(self, header, body, write_header):
+        if not body:
+            return
+        pa = self._pa
+        table = pa.csv.read_csv(io.BytesIO(header + b"\n" + body),
+                                convert_options=pa.csv.ConvertOptions(column_types=self._schema))
+        self._out_fh.write_table(table)
+        self.current_file_size = self._raw_fh.tell()
+
+    def _roll_over(self):
+        super()._roll_over()
+        self._skip_existing_files()
+
+
+class VinCache:
+    """
+    Persistent cache of decoded rows keyed by VIN, backed by sqlite, so repeat runs skip VINs already decoded.
 
-        # Filter out blank lines (lines that are empty after stripping whitespace)
-        cleaned_lines = [line for line in lines if line.strip()]
+    Each entry keeps the CSV header the row was decoded under, so cached rows are written out exactly
+    like freshly decoded ones. New rows are inserted in transactions of CACHE_INSERT_BATCH_SIZE.
 
-        if len(cleaned_lines) == len(lines):
-            print(f"Post-processing: No blank rows found in {file_path}. No changes made.")
-        else:
-            # Re-join lines, ensuring they all end with a proper newline.
-            # The original lines in cleaned_lines still have their original newlines.
-            # To ensure consistent os.linesep:
-            processed_cleaned_lines = [line.rstrip('\r\n') + os.linesep for line in cleaned_lines]
+    Args:
+        path (str): Path of the sqlite database file, or None to disable caching.
+    """
+
+    def __init__(self, path=CACHE_PATH):
+        self._conn = None
+        self._pending_rows = []
+        self._vin_column_indexes = {}  # header -> index of its VIN column, or None if it has none
+        if path:
+            # Rows are looked up before the writer thread starts and inserted from it, never concurrently
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cache (vin TEXT PRIMARY KEY, header TEXT NOT NULL, row TEXT NOT NULL)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _vin_column_index(self, header):
+        if header not in self._vin_column_indexes:
+            columns = [column.strip().lower() for column in next(csv.reader([header]))]
+            self._vin_column_indexes[header] = columns.index('vin') if 'vin' in columns else None
+        return self._vin_column_indexes[header]
+
+    def partition(self, vin_list):
+        """
+        Splits VINs into those already in the cache and those that still need decoding.
+
+        Args:
+            vin_list (list): A list of VIN strings.
+
+        Returns:
+            tuple: (dict mapping each header to the list of cached rows under it, both as bytes,
+                list of VINs not in the cache)
+        """
+        if self._conn is None:
+            return {}, vin_list
+
+        cached = {}
+        keys = list(dict.fromkeys(vin.upper() for vin in vin_list))
+        for start in range(0, len(keys), CACHE_QUERY_CHUNK_SIZE):
+            chunk = keys[start:start + CACHE_QUERY_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            for vin, header, row in self._conn.execute(
+                    f"SELECT vin, header, row FROM cache WHERE vin IN ({placeholders})", chunk):
+                cached[vin] = (header.encode(), row.encode())
+
+        cached_rows_by_header = {}
+        uncached_vins = []
+        for vin in vin_list:
+            entry = cached.get(vin.upper())
+            if entry is None:
+                uncached_vins.append(vin)
+            else:
+                cached_rows_by_header.setdefault(entry[0], []).append(entry[1])
+        return cached_rows_by_header, uncached_vins
+
+    def add(self, header, body):
+        """
+        Queues the rows of a decoded batch for insertion into the cache.
+
+        Args:
+            header (bytes): The header line of the batch.
+            body (bytes): The batch's data lines joined by newlines, as returned by parse_batch.
+        """
+        if self._conn is None or not body:
+            return
+        header = header.decode()
+        vin_idx = self._vin_column_index(header)
+        if vin_idx is None:
+            return
+
+        rows = body.decode().split("\n")
+        for row, fields in zip(rows, csv.reader(rows)):
+            if len(fields) > vin_idx and fields[vin_idx]:
+                self._pending_rows.append((fields[vin_idx].upper(), header, row))
+        if len(self._pending_rows) >= CACHE_INSERT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Inserts all queued rows in a single transaction.
+        """
+        if self._conn is not None and self._pending_rows:
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO cache (vin, header, row) VALUES (?, ?, ?)",
+                                       self._pending_rows)
+            self._pending_rows = []
+
+    def close(self):
+        """
+        Flushes queued rows and closes the database, if caching is enabled.
+        """
+        if self._conn is not None:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+
+
+def vin_check_digit_ok(vin):
+    """
+    Checks the position-9 check digit of a well-formed VIN (one that matches VIN_PATTERN).
 
-            with open(file_path, 'w') as f:
-                f.writelines(processed_cleaned_lines)
-            print(f"Post-processing: Removed {len(lines) - len(cleaned_lines)} blank row(s) from {file_path}.")
+    Args:
+        vin (str): The VIN to check.
 
-    except IOError as e:
-        print(f"Post-processing: IOError while processing {file_path}: {e}")
-    except Exception as e:
-        print(f"Post-processing: An unexpected error occurred while processing {file_path}: {e}")
+    Returns:
+        bool: True if the check digit matches the weighted sum of the other characters.
+    """
+    vin = vin.upper()
+    remainder = sum(VIN_CHAR_VALUES[char] * weight for char, weight in zip(vin, VIN_POSITION_WEIGHTS)) % 11
+    return vin[8] == ('X' if remainder == 10 else str(remainder))
 
 
-def decode_vins_in_batches(vin_list, base_output_filename="decoded_vins_output", max_file_size_mb=500):
+def filter_valid_vins(vin_list, check_digit=False):
     """
-    Decodes a list of VINs in batches using the NHTSA API and saves results incrementally.
+    Drops entries that are not well-formed VINs, so no API call is spent on them.
 
     Args:
         vin_list (list): A list of VIN strings.
-        base_output_filename (str): The base name for output JSON files.
-        max_file_size_mb (int): Maximum size in MB for each JSON file before rollover.
+        check_digit (bool): Whether to also drop VINs whose check digit does not match. Only North American
+            VINs are required to carry a valid check digit, so leave this off for other markets.
 
     Returns:
-        int: The total number of successfully decoded VINs.
+        list: The VINs that are 17 characters long and use only the VIN alphabet.
     """
-    if not vin_list:
-        print("No VINs provided to decode.")
-        return 0, []  # Return count and empty list of files
+    valid_vins = [vin for vin in vin_list if VIN_PATTERN.fullmatch(vin)]
+    num_invalid = len(vin_list) - len(valid_vins)
+    if num_invalid:
+        logger.warning("Skipping %d malformed VIN(s) that are not 17 valid VIN characters.", num_invalid)
 
-    total_successfully_decoded_vins = 0
-    current_file_index = 0
-    current_headers = None
-    written_files = set()
+    if check_digit:
+        num_well_formed = len(valid_vins)
+        valid_vins = [vin for vin in valid_vins if vin_check_digit_ok(vin)]
+        num_bad_check_digit = num_well_formed - len(valid_vins)
+        if num_bad_check_digit:
+            logger.warning("Skipping %d VIN(s) with an invalid check digit.", num_bad_check_digit)
+    return valid_vins
 
-    batch_size = 50
-    num_batches = (len(vin_list) + batch_size - 1) // batch_size
 
-    for i in range(num_batches):
-        start_index = i * batch_size
-        end_index = start_index + batch_size
-        batch_vins = vin_list[start_index:end_index]
+def parse_batch(raw_lines):
+    """
+    Splits the lines of an API batch's CSV response into its header and data lines in a single pass.
 
-        vin_string = ';'.join(batch_vins)
-        api_url = 'https://vpic.nhtsa.dot.gov/api/vehicles/DecodeVINValuesBatch/'
-        payload = {'format': 'csv', 'data': vin_string}
+    Lines are stripped and blank lines are dropped. Lines stay as bytes end to end, so the response
+    is never decoded and the output is never re-encoded.
 
-        print(f"Processing batch {i + 1}/{num_batches} ({len(batch_vins)} VINs)...")
+    Args:
+        raw_lines (iterable): The lines of the CSV response as bytes, e.g. from Response.iter_lines.
 
-        try:
-            response = requests.post(api_url, data=payload, timeout=30)
+    Returns:
+        tuple: (header line or None if the batch is empty, number of data lines, data lines joined by newlines)
+    """
+    lines = [line for line in (raw_line.strip() for raw_line in raw_lines) if line]
+    if not lines:
+        return None, 0, b""
+    return lines[0], len(lines) - 1, b"\n".join(lines[1:])
+
+
+def post_batch(batch):
+    """
+    Sends one batch of VINs to the NHTSA batch decode endpoint over the shared session.
+
+    The response is streamed and parsed line by line as it arrives, so the body is never held
+    both as one large buffer and as a list of lines.
+
+    Args:
+        batch (tuple): (batch_index, batch_vins) where batch_vins is a list of VIN strings.
+
+    Returns:
+        tuple: The parsed batch, as returned by parse_batch.
+
+    Raises:
+        requests.exceptions.RequestException: If the request fails or returns an error status.
+    """
+    _, batch_vins = batch
+    payload = {'format': 'csv', 'data': ';'.join(batch_vins)}
+    with session.post(API_URL, data=payload, timeout=30, stream=True) as response:
+        if not response.ok:
+            # Load the error body before the connection is released so it can still be logged
+            response.content
             response.raise_for_status()
+        return parse_batch(response.iter_lines(chunk_size=RESPONSE_CHUNK_SIZE))
 
-            raw_csv_data_from_batch = response.text
-
-            if raw_csv_data_from_batch and raw_csv_data_from_batch.strip():
-
-                processed_lines = [line.strip() for line in raw_csv_data_from_batch.strip().splitlines()]
-                processed_lines = [line for line in processed_lines if line]
-
-                num_data_lines_in_batch = len(processed_lines) - 1 if processed_lines else -1
-
-                if num_data_lines_in_batch >= 0:  # Changed to >= 0 to handle header-only batches for file creation
-                    current_file_index, current_headers, actual_filename_written = append_results_to_csv_with_rollover(
-                        raw_csv_data_from_batch,
-                        base_output_filename,
-                        current_file_index,
-                        max_file_size_mb,
-                        current_headers
-                    )
-                    if os.path.exists(actual_filename_written):  # Ensure file was actually written
-                        written_files.add(actual_filename_written)
-
-                    if num_data_lines_in_batch > 0:
-                        total_successfully_decoded_vins += num_data_lines_in_batch
-                    elif num_data_lines_in_batch == 0 and len(processed_lines) == 1:
-                        print(
-                            f"Info: Batch {i + 1} returned CSV data with only a header line. CSV: {raw_csv_data_from_batch[:200]}")
-                        if not current_headers:  # If we don't have headers yet, and this batch gave us one
-                            header_line = processed_lines[0]
-                            if header_line:
-                                current_headers = header_line
-                else:
-                    print(
-                        f"Warning: Batch {i + 1} returned CSV data but it appears to be empty or malformed after stripping. CSV: {raw_csv_data_from_batch[:200]}")
-            else:
-                print(
-                    f"Warning: Batch {i + 1} returned no results or empty CSV. Response text: {raw_csv_data_from_batch}")
 
-        except requests.exceptions.HTTPError as e:
-            print(f"HTTP error for batch {i + 1}: {e}")
-            print(f"Response content: {response.text}")
-        except requests.exceptions.RequestException as e:
-            print(f"Request exception for batch {i + 1}: {e}")
-        except Exception as e:
-            print(f"An unexpected error occurred during API call for batch {i + 1}: {e}")
+def _process_one(batch):
+    """
+    Fetches and parses one batch, logging any failure instead of raising it.
+
+    Args:
+        batch (tuple): (batch_index, batch_vins) where batch_vins is a list of VIN strings.
+
+    Returns:
+        tuple or None: (batch_index, number of VINs in the batch, parsed batch as returned by parse_batch),
+            or None if the request failed.
+    """
+    i, batch_vins = batch
+    try:
+        return i, len(batch_vins), post_batch(batch)
+    except requests.exceptions.HTTPError as e:
+        # Decode the raw body directly; .text would run charset detection on it first
+        logger.error("HTTP error for batch %d: %s. Response content: %s",
+                     i + 1, e, e.response.content.decode('ascii', 'replace'))
+    except requests.exceptions.RequestException as e:
+        logger.error("Request exception for batch %d: %s", i + 1, e)
+    except Exception as e:
+        logger.error("An unexpected error occurred during API call for batch %d: %s", i + 1, e)
+    return None
+
+
+def decode_vins_in_batches(vin_list, base_output_filename="decoded_vins_output", max_file_size_mb=500,
+                           max_workers=MAX_CONCURRENT_BATCHES, max_in_flight=MAX_IN_FLIGHT_BATCHES, compress=False,
+                           output_format="csv", skip_invalid_vins=True, batch_size=BATCH_SIZE, cache_path=CACHE_PATH,
+                           validate_check_digit=False):
+    """
+    Decodes a list of VINs in batches using the NHTSA API and saves results incrementally.
+
+    VINs found in the cache are written first, in batch_size chunks. The remaining VINs are fetched
+    and parsed concurrently in batches, then handed in input order to a single writer thread through
+    a bounded queue, so file writes stay serialized and fetching stalls once WRITE_QUEUE_SIZE parsed
+    batches are waiting to be written. At most max_in_flight batches are submitted but not yet
+    queued at any time. A batch whose CSV headers differ from the current file's starts a new file.
+
+    Args:
+        vin_list (list): A list of VIN strings.
+        base_output_filename (str): The base name for output files.
+        max_file_size_mb (int): Maximum size in MB for each output file before rollover.
+        max_workers (int): Maximum number of batches requested concurrently.
+        max_in_flight (int): Maximum number of batches submitted but not yet queued for writing.
+        compress (bool): Whether to write zstd-compressed CSV files (requires zstandard).
+        output_format (str): "csv" or "parquet" (requires pyarrow; always zstd-compressed).
+        skip_invalid_vins (bool): Whether to drop malformed VINs before batching. Disable this to send
+            partial VINs (e.g. with '*' wildcards) to the API.
+        batch_size (int): Number of VINs per API call. NHTSA accepts at most 50.
+        cache_path (str): Path of the sqlite cache of decoded VINs; VINs found there are written from the
+            cache instead of being sent to the API. None disables the cache.
+        validate_check_digit (bool): Whether skip_invalid_vins also drops VINs with a wrong check digit.
+            Only North American VINs are required to have one.
+
+    Returns:
+        tuple: (total number of successfully decoded VINs, list of files written to)
+    """
+    if output_format not in ("csv", "parquet"):
+        raise ValueError(f"Unsupported output format: {output_format!r}")
+
+    if skip_invalid_vins:
+        vin_list = filter_valid_vins(vin_list, check_digit=validate_check_digit)
+
+    if not vin_list:
+        logger.info("No VINs provided to decode.")
+        return 0, []  # Return count and empty list of files
+
+    total_successfully_decoded_vins = 0
+    written_files = set()
+
+    if output_format == "parquet":
+        writer = RolloverParquetWriter(base_output_filename, max_file_size_mb)
+    else:
+        writer = RolloverCsvWriter(base_output_filename, max_file_size_mb, compress=compress)
+
+    write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+
+    def write_batch(header, body, num_data_lines):
+        # Counts the rows and records the file only once the writer has actually stored them
+        nonlocal total_successfully_decoded_vins
+        actual_filename_written = writer.append(header, body)
+        if actual_filename_written is None:
+            return False
+        # Ensure file was actually written; each file only needs checking once
+        if actual_filename_written not in written_files and os.path.exists(actual_filename_written):
+            written_files.add(actual_filename_written)
+        total_successfully_decoded_vins += num_data_lines
+        return True
+
+    def write_batches():
+        # Runs on the writer thread, which owns the output file and the cache inserts
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            i, num_batch_vins, (header, num_data_lines_in_batch, body) = item
+            logger.info("Processing batch %d/%d (%d VINs)...", i + 1, num_batches, num_batch_vins)
+
+            try:
+                if header is not None:
+                    # Header-only batches are still appended so the output file gets created.
+                    # Rows are only cached once they are on disk, so a failed write gets fetched again next run.
+                    if write_batch(header, body, num_data_lines_in_batch):
+                        cache.add(header, body)
+
+                    if num_data_lines_in_batch == 0:
+                        logger.info("Batch %d returned CSV data with only a header line. Header: %s",
+                                    i + 1, header.decode(errors='replace'))
+                else:
+                    logger.warning("Batch %d returned no results or empty CSV.", i + 1)
+            except Exception as e:
+                # Keep draining the queue, otherwise the fetching threads would block on it forever
+                logger.error("An unexpected error occurred while writing batch %d: %s", i + 1, e)
+
+    with writer, VinCache(cache_path) as cache:
+        cached_rows_by_header, vin_list = cache.partition(vin_list)
+        for header, rows in cached_rows_by_header.items():
+            logger.info("Writing %d cached VIN(s)...", len(rows))
+            # Same batch size as fetched batches, so the rollover size check runs just as often
+            for start in range(0, len(rows), batch_size):
+                chunk = rows[start:start + batch_size]
+                write_batch(header, b"\n".join(chunk), len(chunk))
+
+        num_batches = (len(vin_list) + batch_size - 1) // batch_size
+        batch_iter = ((i, vin_list[i * batch_size:(i + 1) * batch_size]) for i in range(num_batches))
+
+        writer_thread = threading.Thread(target=write_batches, daemon=True)
+        writer_thread.start()
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # Results are collected in submission order, so batches are written in input order
+                in_flight = deque(executor.submit(_process_one, batch) for batch in islice(batch_iter, max_in_flight))
+                while in_flight:
+                    result = in_flight.popleft().result()
+                    for batch in islice(batch_iter, 1):
+                        in_flight.append(executor.submit(_process_one, batch))
+                    if result is not None:
+                        write_queue.put(result)
+        finally:
+            write_queue.put(None)
+            writer_thread.join()
 
     if total_successfully_decoded_vins == 0:
-        print("No data was successfully decoded from any batch.")
+        logger.warning("No data was successfully decoded from any batch.")
 
     return total_successfully_decoded_vins, list(written_files)
 
 
 if __name__ == '__main__':
-    print("Starting VIN decoding process...")
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    logger.info("Starting VIN decoding process...")
 
     vins_to_decode = read_vins_from_csv(file_path="to_be_decoded.csv", vin_column_name="VIN")
 
     if not vins_to_decode:
-        print("No VINs found or error in reading CSV. Exiting.")
+        logger.error("No VINs found or error in reading CSV. Exiting.")
     else:
-        print(f"Successfully read {len(vins_to_decode)} VINs from CSV.")
+        logger.info("Successfully read %d VINs from CSV.", len(vins_to_decode))
 
         successfully_decoded_count, files_written_to = decode_vins_in_batches(vins_to_decode)
 
         if successfully_decoded_count == 0:
-            print("VIN decoding process resulted in no data being successfully decoded and saved. Exiting.")
+            logger.error("VIN decoding process resulted in no data being successfully decoded and saved. Exiting.")
         else:
-            print(f"Successfully decoded {successfully_decoded_count} VINs overall.")
-            print(f"Data saved to the following file(s): {', '.join(files_written_to)}")
-            # Post-process each written file to remove blank rows
-            if files_written_to:
-                print("Starting post-processing to remove blank rows from output files...")
-                for f_path in files_written_to:
-                    remove_blank_rows_from_file(f_path)
-                print("Post-processing complete.")
-            print("VIN decoding process completed successfully.")
+            logger.info("Successfully decoded %d VINs overall.", successfully_decoded_count)
+            logger.info("Data saved to the following file(s): %s", ', '.join(files_written_to))
+            logger.info("VIN decoding process completed successfully.")